@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+#
+# LISC toolkit
+# Frame calibration benchmark
+#
+# Compares the fused `CameraCalibration.calibrate` kernel to the previous
+# chain of whole-frame float64 operations (`correct_linearity`, then
+# `correct_flat`) on a synthetic full frame, in time, peak memory allocated
+# and largest relative difference. The kernel works in float32, from a frame
+# decoded as float32, so the difference is of the order of 1e-7.
+#
+# Usage: python benchmarks/calibration.py [repeat]
+
+import os
+import sys
+import tempfile
+import timeit
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+import yaml
+
+
+def setup(home, shape):
+    datadir = os.path.join(home, ".LISC", "BENCH")
+    os.makedirs(datadir)
+    exposure = np.geomspace(30, 1e-4, 40)
+    response = 1 - np.exp(-exposure / 10)
+    pd.DataFrame(
+        {"Exposure": exposure, "R": response, "G": response * 0.9, "B": response}
+    ).to_csv(os.path.join(datadir, "linearity.csv"))
+    rng = np.random.default_rng(0)
+    flat = (0.5 + rng.random(shape) / 2).astype(np.float32)
+    np.save(os.path.join(datadir, "flatfield.npy"), flat)
+    np.savetxt(os.path.join(datadir, "photometry.dat"), [1.2, 0.9, 1.1])
+    with open(os.path.join(datadir, "params"), "w") as f:
+        yaml.safe_dump(dict(cam_key="BENCH"), f)
+
+
+def peak(func):
+    tracemalloc.start()
+    func()
+    size = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return size
+
+
+def main(repeat=5):
+    shape = (1416, 2128, 3)
+    with tempfile.TemporaryDirectory() as home:
+        os.environ["HOME"] = home
+        setup(home, shape)
+        from lisc.camera import CameraCalibration
+        from lisc.utils import correct_flat, correct_linearity
+
+        cal = CameraCalibration.load("BENCH")
+        lin_data = pd.read_csv(cal.path("linearity.csv"))
+        flat_data = np.load(cal.path("flatfield.npy"))
+        rng = np.random.default_rng(1)
+        # Frame as decoded by the previous float64 and current float32 open_raw
+        frame64 = rng.random(shape) ** 4
+        frame = frame64.astype(np.float32)
+        exposure = 0.5
+
+        def previous():
+            return correct_flat(correct_linearity(frame64, lin_data), flat_data) * (
+                cal.photometry / exposure
+            )
+
+        out = np.empty(shape)
+        cases = [
+            ("whole-frame chain (previous)", previous),
+            ("fused kernel", lambda: cal.calibrate(frame, exposure)),
+            (
+                "fused kernel, reused output",
+                lambda: cal.calibrate(frame, exposure, out),
+            ),
+        ]
+
+        expected = previous()
+        for name, func in cases:
+            t = min(timeit.repeat(func, number=1, repeat=repeat))
+            mem = peak(func) / 2**20
+            err = np.max(np.abs(func() / expected - 1))
+            print(
+                f"{name:30s} {t * 1000:8.1f} ms {mem:8.1f} MiB   "
+                f"max rel difference {err:.2e}"
+            )
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+#
+# LISC toolkit
+# Linearity correction benchmark
+#
+# Compares the precomputed `LinearityCorrector` to the previous
+# `correct_linearity` implementation on a synthetic full frame.
+#
+# Usage: python benchmarks/linearity.py [repeat]
+
+import sys
+import timeit
+
+import numpy as np
+import pandas as pd
+
+from lisc.utils import LinearityCorrector
+
+
+def reference(data, lin_data):
+    idx = np.argmin(np.abs(lin_data["Exposure"] - 0.05))
+
+    return np.stack(
+        [
+            np.interp(layer, lin_data[band][::-1], c)
+            for band, layer, c in zip(
+                "RGB",
+                np.moveaxis(data, -1, 0),
+                (
+                    lin_data[band][idx]
+                    / lin_data["Exposure"][idx]
+                    * lin_data["Exposure"][::-1]
+                    for band in "RGB"
+                ),
+            )
+        ],
+        axis=2,
+    )
+
+
+def main(repeat=5):
+    exposure = np.geomspace(30, 1e-4, 40)
+    response = 1 - np.exp(-exposure / 10)
+    lin_data = pd.DataFrame(
+        {"Exposure": exposure, "R": response, "G": response * 0.9, "B": response}
+    )
+
+    rng = np.random.default_rng(0)
+    frame = rng.random((1416, 2128, 3)) ** 4
+    frame32 = frame.astype(np.float32)
+    expected = reference(frame, lin_data)
+
+    out = np.empty_like(frame32)
+    exact64 = LinearityCorrector(lin_data, dtype=np.float64)
+    exact32 = LinearityCorrector(lin_data)
+    lut4096 = LinearityCorrector(lin_data, 4096)
+    lut65536 = LinearityCorrector(lin_data, 65536)
+    cases = [
+        ("correct_linearity (previous)", lambda: reference(frame, lin_data)),
+        ("LinearityCorrector, float64", lambda: exact64(frame)),
+        ("LinearityCorrector, float32", lambda: exact32(frame32, out=out)),
+        ("LinearityCorrector, LUT 4096", lambda: lut4096(frame32, out=out)),
+        ("LinearityCorrector, LUT 65536", lambda: lut65536(frame32, out=out)),
+    ]
+
+    for name, func in cases:
+        t = min(timeit.repeat(func, number=1, repeat=repeat))
+        err = np.max(np.abs(func() - expected))
+        print(f"{name:32s} {t * 1000:8.1f} ms   max abs error {err:.2e}")
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+#
+# LISC toolkit
+# On-disk caches of decoded frames and master darks
+#
+# Author : Alexandre Simoneau
+#
+# Created: October 2026
+
+import hashlib
+import os
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+
+class FrameCache:
+    """Least recently used cache of decoded frames stored as `.npy` files.
+
+    Entries are keyed by the absolute path, modification time and size of the
+    source file, along with any extra decoding parameters. They are returned
+    as copy-on-write memory maps. Once the total size exceeds `max_size`
+    bytes, the least recently used entries are evicted.
+    """
+
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size
+
+    def key(self, fname, *extra):
+        st = os.stat(fname)
+        ident = [os.path.abspath(fname), st.st_mtime_ns, st.st_size, *extra]
+        return hashlib.sha1(repr(ident).encode()).hexdigest()
+
+    def filename(self, key):
+        return os.path.join(self.path, key + ".npy")
+
+    def load(self, fname, func, *extra):
+        """Return the cached result of `func()` for `fname`.
+
+        `func` is only called on a cache miss, its result is then stored.
+        """
+        cached = self.filename(self.key(fname, *extra))
+        try:
+            data = np.load(cached, mmap_mode="c")
+        except (OSError, ValueError):
+            data = func()
+            self.store(cached, data)
+            try:
+                # Reopen from disk so that the caller holds a memory map
+                data = np.load(cached, mmap_mode="c")
+            except (OSError, ValueError):
+                pass  # Not stored or already evicted
+        else:
+            try:
+                os.utime(cached)  # Mark as recently used
+            except FileNotFoundError:
+                pass  # Evicted by a concurrent process, the map stays valid
+        return data
+
+    def store(self, cached, data):
+        os.makedirs(self.path, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(suffix=".npy", dir=self.path)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.save(f, data)
+            os.replace(tmp, cached)
+        except OSError:
+            if os.path.isfile(tmp):
+                os.remove(tmp)
+            return
+        self.evict()
+
+    def entries(self):
+        try:
+            names = os.listdir(self.path)
+        except FileNotFoundError:
+            return []
+        entries = []
+        for name in names:
+            try:
+                st = os.stat(os.path.join(self.path, name))
+            except FileNotFoundError:
+                continue  # Removed by a concurrent process
+            entries.append((st.st_mtime, st.st_size, name))
+        return sorted(entries)
+
+    def size(self):
+        return sum(size for mtime, size, name in self.entries())
+
+    def evict(self, max_size=None):
+        if max_size is None:
+            max_size = self.max_size
+        entries = self.entries()
+        total = sum(size for mtime, size, name in entries)
+        for mtime, size, name in entries:
+            if total <= max_size:
+                break
+            try:
+                os.remove(os.path.join(self.path, name))
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def clear(self):
+        self.evict(0)
+
+
+class DarkLibrary:
+    """Library of master darks shared by every working directory.
+
+    Master darks are stored as `.npy` files next to an `index.csv` file
+    listing their key, camera, frame shape, exposure, ISO, temperature and
+    clipping value. The key is a hash of the input file set (paths,
+    modification times and sizes) and of the clipping value, so that a
+    modified dark set is recomputed.
+    """
+
+    columns = [
+        "key",
+        "camera",
+        "shape",
+        "exposure",
+        "iso",
+        "temperature",
+        "sigclip",
+        "nframes",
+    ]
+
+    def __init__(self, path):
+        self.path = path
+
+    def key(self, fnames, sigclip):
+        ident = []
+        for fname in sorted(os.path.abspath(f) for f in fnames):
+            st = os.stat(fname)
+            ident.append((fname, st.st_mtime_ns, st.st_size))
+        return hashlib.sha1(repr((ident, float(sigclip))).encode()).hexdigest()
+
+    def filename(self, key):
+        return os.path.join(self.path, key + ".npy")
+
+    def index(self):
+        try:
+            index = pd.read_csv(os.path.join(self.path, "index.csv"))
+        except FileNotFoundError:
+            return pd.DataFrame(columns=self.columns)
+        # Entries of older indexes lack some columns and never match
+        return index.reindex(columns=self.columns)
+
+    def load(self, key):
+        try:
+            return np.load(self.filename(key), mmap_mode="r")
+        except FileNotFoundError:
+            return None
+
+    def store(self, key, data, **meta):
+        """Save a master dark and index it with `meta`.
+
+        Master darks without a numeric exposure can't be matched to images,
+        so they are saved but not indexed.
+        """
+        os.makedirs(self.path, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(suffix=".npy", dir=self.path)
+        with os.fdopen(fd, "wb") as f:
+            np.save(f, data)
+        os.replace(tmp, self.filename(key))
+
+        index = self.index()
+        index = index[index["key"] != key]
+        if "shape" in meta:
+            meta["shape"] = self.shape_str(meta["shape"])
+        if isinstance(meta.get("exposure"), (int, float)):
+            entry = pd.DataFrame([dict(meta, key=key)], columns=self.columns)
+            index = pd.concat([index, entry] if len(index) else [entry])
+        fd, tmp = tempfile.mkstemp(suffix=".csv", dir=self.path)
+        with os.fdopen(fd, "w") as f:
+            index.to_csv(f, index=False)
+        os.replace(tmp, os.path.join(self.path, "index.csv"))
+
+    @staticmethod
+    def shape_str(shape):
+        return "x".join(str(n) for n in shape)
+
+    def nearest(self, exposure, iso, camera, shape, temperature=None, max_ratio=1.5):
+        """Key of the master dark closest in exposure, then in temperature.
+
+        Only darks of the same camera, frame shape and ISO, with an exposure
+        within a factor `max_ratio` of `exposure`, are considered. Returns
+        None if there is none.
+        """
+        index = self.index()
+        exists = [os.path.isfile(self.filename(k)) for k in index["key"]]
+        index = index.loc[np.array(exists, dtype=bool)]
+        index = index[
+            (index["camera"] == camera)
+            & (index["shape"] == self.shape_str(shape))
+            & (index["iso"] == iso)
+        ]
+        index = index.assign(
+            dexp=np.abs(
+                np.log(pd.to_numeric(index["exposure"], errors="coerce") / exposure)
+            ),
+            dtemp=(
+                np.abs(index["temperature"].astype(float) - temperature)
+                if temperature is not None
+                else 0
+            ),
+        )
+        index = index[index["dexp"] <= np.log(max_ratio)]
+        if not len(index):
+            return None
+        return index.sort_values(["dexp", "dtemp"])["key"].iloc[0]
+
+
+raw_cache = FrameCache(
+    os.path.expanduser(os.environ.get("LISC_CACHE_DIR", "~/.LISC/cache")),
+    float(os.environ.get("LISC_CACHE_SIZE", 20)) * 2**30,
+)
+dark_library = DarkLibrary(
+    os.path.expanduser(os.environ.get("LISC_DARKS_DIR", "~/.LISC/darks"))
+)
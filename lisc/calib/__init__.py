@@ -0,0 +1,5 @@
+from .calib import calib
+from .flatfield import flatfield
+from .linearity import linearity
+from .photometry import photometry
+from .starfield import starfield
@@ -9,47 +9,218 @@
 # Edited: April 2021
 
 import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 
 import imageio
 import numpy as np
-import pandas as pd
+from lisc.cache import dark_library
+from lisc.camera import CameraCalibration
+from lisc.cube import CubeWriter
 from lisc.utils import (
-    correct_flat,
-    correct_linearity,
     cosmicray_removal,
-    exif_read,
-    open_clipped,
+    exif_camera,
+    exif_read_many,
+    master_dark,
     open_raw,
+    raw_shape,
 )
 
+# Tile size of the cosmic ray removal when run on several threads or prefiltered
+CR_TILE = 512
 
-def calib(cam_key, images, darks, fmt="npy", sigclip=5):
-    if fmt not in ["npy", "tif"]:
+# Calibration data of the current worker process, loaded once by `_init_worker`
+_worker = dict()
+
+
+def _init_worker(cam_key, fmt, sigclip, cr_jobs, cr_prefilter):
+    _worker.clear()
+    _worker.update(
+        cal=CameraCalibration.load(cam_key),
+        darks=dict(),
+        fmt=fmt,
+        sigclip=sigclip,
+        cr_jobs=cr_jobs,
+        cr_prefilter=cr_prefilter,
+        buffer=None,
+        output=None,
+    )
+
+
+def _calibrate(fname, exposure, dark_key):
+    w = _worker
+    if dark_key not in w["darks"]:
+        w["darks"][dark_key] = dark_library.load(dark_key)
+    dark = w["darks"][dark_key]
+
+    cal = w["cal"]
+    print(f"Calibrating '{fname}'...")
+    # Every step works in place on buffers reused between frames
+    if w["buffer"] is None or w["buffer"].shape != dark.shape:
+        w["buffer"] = np.empty(dark.shape, dtype=np.float32)
+        w["output"] = None
+    buffer = open_raw(fname, out=w["buffer"])
+    buffer -= dark
+    tiled = w["cr_jobs"] != 1 or w["cr_prefilter"] is not None
+    cr_stats = dict()
+    cosmicray_removal(
+        buffer,
+        out=buffer,
+        tile=CR_TILE if tiled else None,
+        n_jobs=w["cr_jobs"],
+        prefilter=w["cr_prefilter"],
+        stats=cr_stats,
+        sigclip=w["sigclip"],
+    )
+    data = w["output"] = cal.calibrate(buffer, exposure, out=w["output"])
+
+    if w["fmt"] == "cube":
+        # Written to the cube by the main process
+        return data.astype(np.float32), cr_stats
+
+    new_name = fname.rsplit(".", 1)[0]
+    if w["fmt"] == "npy":
+        np.save(new_name, data)
+    elif w["fmt"] == "tif":
+        imageio.imsave(new_name + ".tif", data)
+
+    return f"{new_name}.{w['fmt']}", cr_stats
+
+
+def calib(
+    cam_key,
+    images,
+    darks,
+    fmt="npy",
+    sigclip=5,
+    jobs=1,
+    output="calibrated.cube",
+    compress=False,
+    cr_jobs=1,
+    cr_prefilter=None,
+):
+    """Calibrate `images` using the data saved for `cam_key`.
+
+    If no `darks` are given, the master dark of the library closest to each
+    image in exposure and temperature is used instead, among those of the
+    same camera, frame shape and ISO within a factor 1.5 in exposure.
+
+    With `jobs` > 1 (or <= 0 for all cores), the frames are distributed over a
+    pool of worker processes. Each worker loads the calibration data once and
+    at most `2*jobs` frames are in flight at any time. The cosmic ray removal
+    of each frame is further split in tiles over `cr_jobs` threads. With
+    `cr_prefilter`, tiles without cosmic ray candidates are not filtered, see
+    `lisc.utils.cosmicray_removal`. The number of skipped tiles is reported.
+
+    With the 'cube' format, all frames are written as float32 to a single
+    chunked cube at `output`, optionally compressed, along with their
+    filename, time and exposure. See `lisc.cube.Cube` to read it.
+    """
+    if fmt not in ["npy", "tif", "cube"]:
         print(f"ERROR: Unrecognized format '{fmt}'")
         return
 
-    datadir = os.path.expanduser(f"~/.LISC/{cam_key}/")
-    lin_data = pd.read_csv(datadir + "linearity.csv")
-    flat_data = np.load(datadir + "flatfield.npy")
-    dark = open_clipped(darks)
-    photo = np.loadtxt(datadir + "photometry.dat")
+    if jobs <= 0:
+        jobs = os.cpu_count()
+    if cr_jobs <= 0:
+        cr_jobs = os.cpu_count()
+
+    try:
+        # The reciprocal flat field is prepared here, once for all workers
+        CameraCalibration.load(cam_key).flat_scale
+    except (FileNotFoundError, ValueError) as err:
+        print(f"ERROR: {err}")
+        return
+
+    if not images:
+        return []
+
+    exifs = exif_read_many(images)
+    exposures = [exif["ShutterSpeedValue"] for exif in exifs]
+    shapes = [raw_shape(fname) for fname in images]
+    if darks:
+        dark_keys = [master_dark(darks)] * len(images)
+        dark_shape = dark_library.load(dark_keys[0]).shape
+        for fname, shape in zip(images, shapes):
+            if shape != dark_shape:
+                print(f"ERROR: '{fname}' has shape {shape}, the darks {dark_shape}")
+                return
+    else:
+        dark_keys = [
+            dark_library.nearest(
+                exif["ShutterSpeedValue"],
+                exif["ISO"],
+                exif_camera(exif),
+                shape,
+                None if type(exif["Temperature"]) == str else exif["Temperature"],
+            )
+            for exif, shape in zip(exifs, shapes)
+        ]
+        missing = [fname for fname, key in zip(images, dark_keys) if key is None]
+        if missing:
+            print(
+                "ERROR: No darks given and the library has no master dark of the "
+                "same camera, shape and ISO with a close exposure for:\n  "
+                + "\n  ".join(missing)
+            )
+            return
 
+    initargs = (cam_key, fmt, sigclip, cr_jobs, cr_prefilter)
+    tasks = list(zip(images, exposures, dark_keys))
+
+    writer = CubeWriter(output, compress=compress) if fmt == "cube" else None
+
+    cr_stats = dict(tiles=0, skipped=0)
+
+    def collect(result):
+        # Results are collected in the order of `images`
+        result, stats = result
+        for k in cr_stats:
+            cr_stats[k] += stats[k]
+        i = len(new_names)
+        if writer is None:
+            new_names.append(result)
+        else:
+            writer.append(
+                result,
+                Filename=os.path.basename(images[i]),
+                Time=exifs[i]["DateTimeOriginal"],
+                Exposure=exposures[i],
+            )
+            new_names.append(output)
+
+    start = time.perf_counter()
     new_names = []
-    for fname in images:
-        print(f"Calibrating '{fname}'...")
-        data = correct_flat(
-            correct_linearity(
-                cosmicray_removal(open_raw(fname) - dark, sigclip=sigclip),
-                lin_data,
-            ),
-            flat_data,
-        ) * (photo / exif_read(fname)["ShutterSpeedValue"])
-
-        new_name = fname.rsplit(".", 1)[0]
-        if fmt == "npy":
-            np.save(new_name, data)
-        elif fmt == "tif":
-            imageio.imsave(new_name + ".tif", data)
-
-        new_names.append(f"{new_name}.{fmt}")
+    if jobs == 1:
+        _init_worker(*initargs)
+        for task in tasks:
+            collect(_calibrate(*task))
+    else:
+        with ProcessPoolExecutor(
+            jobs, initializer=_init_worker, initargs=initargs
+        ) as pool:
+            pending = deque()
+            for task in tasks:
+                if len(pending) >= 2 * jobs:
+                    collect(pending.popleft().result())
+                pending.append(pool.submit(_calibrate, *task))
+            while pending:
+                collect(pending.popleft().result())
+    if writer is not None:
+        writer.close()
+        new_names = [output]
+    elapsed = time.perf_counter() - start
+
+    if tasks:
+        print(
+            f"Calibrated {len(tasks)} frames in {elapsed:.1f} s "
+            f"({len(tasks) / elapsed:.2f} frames/s)"
+        )
+    if cr_prefilter is not None and cr_stats["tiles"]:
+        print(
+            f"Cosmic ray filtering skipped {cr_stats['skipped']} of "
+            f"{cr_stats['tiles']} tiles "
+            f"({100 * cr_stats['skipped'] / cr_stats['tiles']:.1f}%)"
+        )
     return new_names
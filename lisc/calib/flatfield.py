@@ -11,17 +11,19 @@
 import os
 
 import numpy as np
-import pandas as pd
 import yaml
 from scipy.ndimage import gaussian_filter
 
-from .utils import (
+from ..geometry import Geometry
+from ..utils import (
+    LinearityCorrector,
     blur_image,
-    correct_linearity,
     glob_types,
     open_clipped,
     open_raw,
     parallelize,
+    save_data,
+    split_jobs,
 )
 
 
@@ -32,63 +34,82 @@ def flatfield():
     radius = 5  # degrees
     blur_radius = 1
 
-    lin_data = pd.read_csv("linearity.csv")
-
-    def shift(arr, x, y):
-        arr = np.roll(arr, x, 1)
-        if x > 0:
-            arr[:, :x] = 0
-        else:
-            arr[:, x:] = 0
-        arr = np.roll(arr, y, 0)
-        if y > 0:
-            arr[:y] = 0
-        else:
-            arr[y:] = 0
-        return arr
+    lin_data = LinearityCorrector("linearity.csv")
 
     dark = blur_image(open_clipped("FLATFIELD/DARKS/*"))
 
-    if os.path.isfile("geometry.npy"):
-        fov = np.load("geometry.npy")
+    if os.path.isfile("geometry_params.dat"):
+        geometry = Geometry.load("geometry_params.dat")
     else:
         with open("params") as f:
             params = yaml.safe_load(f)
-        psize = params["pixel_size"] / 1000 * 2
-        f = params["focal_length"]
-
-        Ny, Nx = dark.shape[:2]
-        x = np.arange(Nx, dtype=float) - Nx / 2 + 0.5
-        y = Ny / 2 - np.arange(Ny, dtype=float) + 0.5
-        xx, yy = np.meshgrid(x, y)
-        r = np.sqrt(xx**2 + yy**2)
-        fov = np.arctan(psize * r / f)
-
-    fov = np.rad2deg(fov)
-    circle = fov < radius
-    pixsixe = fov[0, fov.shape[1] // 2] / (fov.shape[0] / 2)
-    blur = gaussian_filter(circle.astype(float), blur_radius / pixsixe)
+        geometry = Geometry.pinhole(dark.shape, params)
+    Ny, Nx = geometry.shape
+
+    pixsixe = np.rad2deg(geometry[0, Nx // 2]) / (Ny / 2)
+    sigma = blur_radius / pixsixe
+
+    # Only the disk and the extent of its blur are evaluated
+    half = int(geometry.radius(np.deg2rad(radius))) + int(4 * sigma + 0.5) + 2
+    box = tuple(slice(max(n // 2 - half, 0), min(n // 2 + half, n)) for n in (Ny, Nx))
+    circle = np.rad2deg(geometry[box]) < radius
+    blur = gaussian_filter(circle.astype(float), sigma)
+
+    # Only the bounding box of the non-zero part of the disk is ever used
+    rows = np.flatnonzero(blur.any(1))
+    cols = np.flatnonzero(blur.any(0))
+    kernel = blur[rows[0] : rows[-1] + 1, cols[0] : cols[-1] + 1]
+    r0, r1 = box[0].start + rows[0], box[0].start + rows[-1] + 1
+    c0, c1 = box[1].start + cols[0], box[1].start + cols[-1] + 1
+
+    def window(x, y):
+        """Frame and kernel slices of the disk shifted by (x, y) pixels."""
+        top, bottom = max(r0 + y, 0), min(r1 + y, Ny)
+        left, right = max(c0 + x, 0), min(c1 + x, Nx)
+        if top >= bottom or left >= right:
+            return None
+        return (
+            (slice(top, bottom), slice(left, right)),
+            (
+                slice(top - r0 - y, bottom - r0 - y),
+                slice(left - c0 - x, right - c0 - x),
+            ),
+        )
 
     @parallelize
-    def process(fname, count, light):
-        foo, el, az = os.path.splitext(os.path.basename(fname))[0].split("_")
-        el, az = float(el), -float(az) - offset
-        r = el / pixsixe
-        x = int(round(r * np.cos(np.deg2rad(az))))
-        y = int(round(r * np.sin(np.deg2rad(az))))
-
-        shifted = shift(blur, x, y)
-        frame = correct_linearity(open_raw(fname) - dark, lin_data)
-        # frame = open_raw(fname) - dark
-
-        count += shifted
-        light += frame * shifted[..., None]
-
-    count = np.zeros(dark.shape[:2], dtype=np.float64)
-    light = np.zeros_like(dark, dtype=np.float64)
-    process(glob_types("FLATFIELD/*"), count, light)
+    def process(fnames):
+        # Each worker accumulates into its own buffers
+        count = np.zeros(dark.shape[:2], dtype=np.float64)
+        light = np.zeros(dark.shape, dtype=np.float64)
+        for fname in fnames:
+            foo, el, az = os.path.splitext(os.path.basename(fname))[0].split("_")
+            el, az = float(el), -float(az) - offset
+            r = el / pixsixe
+            x = int(round(r * np.cos(np.deg2rad(az))))
+            y = int(round(r * np.sin(np.deg2rad(az))))
+
+            slices = window(x, y)
+            if slices is None:
+                continue
+            roi, kernel_roi = slices
+            weight = kernel[kernel_roi]
+
+            frame = lin_data(open_raw(fname, cache=True)[roi] - dark[roi])
+            # frame = open_raw(fname)[roi] - dark[roi]
+
+            count[roi] += weight
+            frame *= weight[..., None]
+            light[roi] += frame
+        return count, light
+
+    # Partial sums are merged in a fixed order for reproducible results
+    partials = process(split_jobs(sorted(glob_types("FLATFIELD/*"))))
+    count, light = partials[0]
+    for partial_count, partial_light in partials[1:]:
+        count += partial_count
+        light += partial_light
     light /= count[..., None]
     flat = blur_image(light)
 
-    np.save("flatfield", flat)
-    np.save("flat_weight", count)
+    save_data("flatfield.npy", flat)
+    save_data("flat_weight.npy", count)
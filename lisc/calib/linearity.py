@@ -14,28 +14,36 @@ from glob import glob
 import numpy as np
 import pandas as pd
 
-from .utils import (
+from ..utils import (
     blur_image,
-    exif_read,
+    exif_read_many,
     glob_types,
-    open_clipped,
-    open_raw,
     parallelize,
+    raw_shape,
+    stack_frames,
 )
 
+# Radius of the blur applied to the darks, and the margin it needs
+BLUR_RADIUS = 25
+MARGIN = 4 * BLUR_RADIUS
+
 
 def linearity(size=50):
     size //= 2
-    set_times = {
-        fname.split(os.sep)[-1].split("_")[0] for fname in glob("LINEARITY/*.*")
-    }
+    set_times = sorted(
+        {fname.split(os.sep)[-1].split("_")[0] for fname in glob("LINEARITY/*.*")}
+    )
 
-    Ny, Nx = open_raw(glob_types("LINEARITY/*")[0]).shape[:2]
-    mask = np.zeros((Ny, Nx), dtype=np.bool8)
-    mask[
-        Ny // 2 - size : Ny // 2 + size + 1,
-        Nx // 2 - size : Nx // 2 + size + 1,
-    ] = True
+    Ny, Nx = raw_shape(glob_types("LINEARITY/*")[0])[:2]
+    # Only the central window and the margin of the blur are decoded
+    roi = tuple(
+        slice(max(n // 2 - size - MARGIN, 0), min(n // 2 + size + 1 + MARGIN, n))
+        for n in (Ny, Nx)
+    )
+    window = tuple(
+        slice(n // 2 - size - s.start, n // 2 + size + 1 - s.start)
+        for n, s in zip((Ny, Nx), roi)
+    )
 
     images = glob_types("LINEARITY/*_*")
     darks = glob_types("LINEARITY/DARKS/*_*")
@@ -43,14 +51,21 @@ def linearity(size=50):
     def filter_fnames(fnames, ss):
         return [f for f in fnames if os.path.basename(f).startswith(f"{ss}_")]
 
-    @parallelize
+    exposures = {
+        ss: exif["ShutterSpeedValue"]
+        for ss, exif in zip(
+            set_times,
+            exif_read_many(filter_fnames(images, ss)[0] for ss in set_times),
+        )
+    }
+
+    @parallelize(prefer="processes")
     def process(ss):
         images_names = filter_fnames(images, ss)
         darks_names = filter_fnames(darks, ss)
-        frame = open_clipped(images_names)[mask]
-        dark = blur_image(open_clipped(darks_names))[mask]
-        exif = exif_read(images_names[0])
-        return (exif["ShutterSpeedValue"], *(frame - dark).mean(0))
+        frame = stack_frames(images_names, roi=roi)[window]
+        dark = blur_image(stack_frames(darks_names, roi=roi), BLUR_RADIUS)[window]
+        return (exposures[ss], *(frame - dark).mean((0, 1)))
 
     data = process(set_times)
 
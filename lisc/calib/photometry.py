@@ -17,15 +17,16 @@ import yaml
 from progressbar import progressbar
 from scipy.ndimage import gaussian_filter
 
-from .utils import (
+from ..utils import (
+    LinearityCorrector,
     blur_image,
     circle_mask,
-    correct_flat,
-    correct_linearity,
     exif_read,
     glob_types,
+    iter_raw,
+    load_data,
     open_clipped,
-    open_raw,
+    parallelize,
 )
 
 # TODO: Use astrometry for star identification
@@ -53,21 +54,47 @@ def photometry(r=50, drift_window=50):
     r /= 2
     drift_window //= 2
 
-    lin_data = pd.read_csv("linearity.csv")
-    flat_data = np.load("flatfield.npy")
+    lin_data = LinearityCorrector("linearity.csv")
+    flat_data = load_data("flatfield.npy")
+    flat_data = flat_data / flat_data.max((0, 1))
 
     dark = blur_image(open_clipped("PHOTOMETRY/DARKS/*"))
+    Ny, Nx = dark.shape[:2]
+
+    # Aperture masks centered on the star, only the region of interest
+    # around the star is calibrated and integrated
+    R = int(np.ceil(2 * r))
+    shape = (2 * R + 1, 2 * R + 1)
+    star_kernel = circle_mask(R, R, shape, r)
+    bgnd_kernel = circle_mask(R, R, shape, 2 * r) & ~circle_mask(R, R, shape, 1.5 * r)
+
+    def aperture(idx, idy):
+        """Frame and kernel slices of the apertures centered on (idx, idy)."""
+        top, bottom = max(idy - R, 0), min(idy + R + 1, Ny)
+        left, right = max(idx - R, 0), min(idx + R + 1, Nx)
+        return (
+            (slice(top, bottom), slice(left, right)),
+            (
+                slice(top - idy + R, bottom - idy + R),
+                slice(left - idx + R, right - idx + R),
+            ),
+        )
+
+    fnames = sorted(glob_types("PHOTOMETRY/*"))
+    # The frames are decoded in parallel a few frames ahead of the tracker,
+    # which only keeps the region of interest of each frame
+    frames = iter_raw(fnames)
 
+    # Sequential star tracking
     idx, idy = p["star_position"]
     idx //= 2
     idy //= 2
-    outs = pd.DataFrame(columns=["Filename", "SAT", "X", "Y", "R", "G", "B"])
+    positions = []
 
     n = 0
-    for fname in progressbar(sorted(glob_types("PHOTOMETRY/*")), redirect_stdout=True):
-        im = open_raw(fname)
-
-        crop = im[
+    for fname in progressbar(fnames, redirect_stdout=True):
+        frame = next(frames)
+        crop = frame[
             idy - drift_window : idy + drift_window,
             idx - drift_window : idx + drift_window,
         ]
@@ -86,19 +113,27 @@ def photometry(r=50, drift_window=50):
         idx += x[0] - drift_window
         idy += y[0] - drift_window
         print(f"Found star at: {idx*2}, {idy*2}")
+        positions.append((fname, idx, idy, np.array(frame[aperture(idx, idy)[0]])))
 
-        star_mask = circle_mask(idx, idy, im.shape, r)
-        bgnd_mask = circle_mask(idx, idy, im.shape, 2 * r) & ~circle_mask(
-            idx, idy, im.shape, 1.5 * r
-        )
+    # Parallel aperture photometry
+    @parallelize
+    def integrate(position):
+        fname, idx, idy, im = position
+        roi, kernel_roi = aperture(idx, idy)
+        star_mask = star_kernel[kernel_roi]
+        bgnd_mask = bgnd_kernel[kernel_roi]
 
         sat = (im[star_mask] > 0.95).any()
-        im = correct_flat(correct_linearity(im - dark, lin_data), flat_data)
+        im = lin_data(im - dark[roi]) / flat_data[roi]
         rad = np.sum(im[star_mask], 0) - (
             np.sum(im[bgnd_mask], 0) * (np.sum(star_mask) / np.sum(bgnd_mask))
         )
 
-        outs.loc[len(outs)] = [basename(fname), sat, idx, idy, *rad]
+        return (basename(fname), sat, idx, idy, *rad)
+
+    outs = pd.DataFrame(
+        integrate(positions), columns=["Filename", "SAT", "X", "Y", "R", "G", "B"]
+    )
 
     exp = exif_read(glob_types("PHOTOMETRY/*")[0])["ShutterSpeedValue"]
 
@@ -13,36 +13,57 @@ import yaml
 from astropy.table import Table
 from scipy.optimize import curve_fit, leastsq
 
-from .utils import glob_types, open_raw
+from ..utils import glob_types, raw_shape
 
 
 def angular_mean(a):
     return np.arctan2(np.mean(np.sin(a)), np.mean(np.cos(a)))
 
 
-def align(coords, params):
-    theta, phi = coords
-    Theta, Phi, beta = params
-
-    a = np.array(
+def unit_vectors(theta, phi):
+    return np.array(
         [
             np.sin(theta) * np.cos(phi),
             np.sin(theta) * np.sin(phi),
             np.cos(theta),
         ]
     )
-    k = np.array(
+
+
+def cross_matrix(k):
+    return np.array(
         [
-            np.sin(Theta) * np.cos(Phi),
-            np.sin(Theta) * np.sin(Phi),
-            np.cos(Theta),
+            [0, -k[2], k[1]],
+            [k[2], 0, -k[0]],
+            [-k[1], k[0], 0],
         ]
     )
-    b = (
-        np.cos(beta) * a
-        + np.sin(beta) * np.cross(k, a.T).T
-        + np.dot(k, a) * (1 - np.cos(beta)) * k[:, None]
+
+
+def rotation(params):
+    """Rotation by `beta` around the axis of angles `Theta`, `Phi`.
+
+    Returns the matrix along with its derivatives by each parameter.
+    """
+    Theta, Phi, beta = params
+    k = unit_vectors(Theta, Phi)
+    dk_dTheta = np.array(
+        [np.cos(Theta) * np.cos(Phi), np.cos(Theta) * np.sin(Phi), -np.sin(Theta)]
     )
+    dk_dPhi = np.array([-np.sin(Theta) * np.sin(Phi), np.sin(Theta) * np.cos(Phi), 0])
+    c, s = np.cos(beta), np.sin(beta)
+
+    R = c * np.eye(3) + s * cross_matrix(k) + (1 - c) * np.outer(k, k)
+    dR = [
+        s * cross_matrix(dk) + (1 - c) * (np.outer(dk, k) + np.outer(k, dk))
+        for dk in (dk_dTheta, dk_dPhi)
+    ]
+    dR.append(-s * np.eye(3) + c * cross_matrix(k) + s * np.outer(k, k))
+    return R, np.array(dR)
+
+
+def align(coords, params):
+    b = rotation(params)[0] @ unit_vectors(*coords)
 
     phip = np.arctan2(b[1], b[0]) % (2 * np.pi)
     thetap = np.arctan2(np.sqrt(b[0] ** 2 + b[1] ** 2), b[2])
@@ -51,25 +72,36 @@ def align(coords, params):
 
 
 def error(params, y, x):
-    ans = align(x, params)
+    # The rotated vectors being unitary, sin(theta) cos(phi) = b[0], etc.
+    u = unit_vectors(*y)[:2]
+    b = rotation(params)[0][:2] @ unit_vectors(*x)
+    return ((u - b) ** 2).sum(0)
+
 
-    return (np.sin(y[0]) * np.cos(y[1]) - np.sin(ans[0]) * np.cos(ans[1])) ** 2 + (
-        np.sin(y[0]) * np.sin(y[1]) - np.sin(ans[0]) * np.sin(ans[1])
-    ) ** 2
+def error_jacobian(params, y, x):
+    u = unit_vectors(*y)[:2]
+    a = unit_vectors(*x)
+    R, dR = rotation(params)
+    # Derivatives of the first two components by each parameter
+    db = dR[:, :2] @ a
+    return (-2 * (u - R[:2] @ a) * db).sum(1).T
 
 
 def radial(alt, b, c, d, e):
     return b * alt + c * alt**2 + d * alt**3 + e * alt**4
 
 
+def radial_jacobian(alt, b, c, d, e):
+    return np.stack([alt, alt**2, alt**3, alt**4], axis=-1)
+
+
 def starfield():
     with open("params") as f:
         params = yaml.safe_load(f)
     psize = params["pixel_size"] / 1000 * 2
     f = params["focal_length"]
 
-    im = open_raw(glob_types("STARFIELD/starfield")[0])
-    Ny, Nx = im.shape[:2]
+    Ny, Nx = raw_shape(glob_types("STARFIELD/starfield")[0])[:2]
 
     db = Table.read("STARFIELD/corr.fits")
 
@@ -83,19 +115,16 @@ def starfield():
     p = (np.pi / 2, angular_mean(phi) - np.pi / 2, theta.mean())
     theta_r, phi_r = align((theta, phi), p)
 
-    p0, foo = leastsq(error, (0, 0, 0), args=((alt, az), (theta_r, phi_r)))
+    p0, foo = leastsq(
+        error, (0, 0, 0), args=((alt, az), (theta_r, phi_r)), Dfun=error_jacobian
+    )
     theta2, phi2 = align((theta_r, phi_r), p0)
 
-    p1, foo = curve_fit(radial, alt, theta2)
-    p2, foo = curve_fit(radial, theta2, alt)
-
-    x = np.arange(Nx, dtype=float) - Nx / 2 + 0.5
-    y = Ny / 2 - np.arange(Ny, dtype=float) + 0.5
-    xx, yy = np.meshgrid(x, y)
-    r = np.sqrt(xx**2 + yy**2)
-    r2 = radial(np.arctan(psize * r / f), *p1)
+    p1, foo = curve_fit(radial, alt, theta2, jac=radial_jacobian)
+    p2, foo = curve_fit(radial, theta2, alt, jac=radial_jacobian)
 
-    np.save("geometry", r2)
+    # The zenith angle map is computed on demand from these parameters,
+    # see `lisc.geometry.Geometry`
 
     def write_line(f, *vals):
         f.write(", ".join(f"{val}" for val in vals) + "\n")
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+#
+# LISC toolkit
+# Camera calibration data
+#
+# Author : Alexandre Simoneau
+#
+# Created: October 2026
+
+import os
+import tempfile
+from functools import cached_property
+from glob import glob
+
+import numpy as np
+import yaml
+
+from .geometry import Geometry
+from .utils import LinearityCorrector, load_data, save_data
+
+DATAFILES = [
+    "params",
+    "linearity.csv",
+    "flatfield.npy",
+    "photometry.dat",
+]
+
+
+class CameraCalibration:
+    """Calibration data saved for a camera with `lisc save`.
+
+    The parameters are read on creation, the other products are loaded and
+    prepared once, the first time they are used. Use `CameraCalibration.load`
+    to share instances within a process.
+    """
+
+    _instances = dict()
+
+    def __init__(self, cam_key):
+        self.cam_key = cam_key
+        self.datadir = os.path.expanduser(f"~/.LISC/{cam_key}/")
+
+        missing = [f for f in DATAFILES if not os.path.isfile(self.path(f))]
+        if missing:
+            raise FileNotFoundError(
+                f"Calibration data for '{cam_key}' is missing: {', '.join(missing)}"
+            )
+
+        self.signature = self._signature()
+        with open(self.path("params")) as f:
+            self.params = yaml.safe_load(f)
+
+    @classmethod
+    def load(cls, cam_key):
+        """Calibration of `cam_key`, reloaded only if its files changed."""
+        cal = cls._instances.get(cam_key)
+        try:
+            if cal is not None and cal.signature == cal._signature():
+                return cal
+        except FileNotFoundError:
+            pass
+        cal = cls._instances[cam_key] = cls(cam_key)
+        return cal
+
+    @staticmethod
+    def available():
+        return sorted(
+            os.path.basename(os.path.dirname(fname))
+            for fname in glob(os.path.expanduser("~/.LISC/*/params"))
+        )
+
+    def path(self, fname):
+        return os.path.join(self.datadir, fname)
+
+    def _signature(self):
+        return [os.stat(self.path(f)).st_mtime_ns for f in DATAFILES]
+
+    @cached_property
+    def linearity(self):
+        return LinearityCorrector(self.path("linearity.csv"))
+
+    @cached_property
+    def flat(self):
+        return load_data(self.path("flatfield.npy"))
+
+    @cached_property
+    def flat_scale(self):
+        """Reciprocal of the normalized flat field.
+
+        It is computed once and saved next to the flat field, then opened as
+        a memory map so that all processes share a single physical copy. It
+        is recomputed if the flat field is more recent.
+        """
+        fname = self.path("flat_scale.npy")
+        try:
+            if (
+                os.stat(fname).st_mtime_ns
+                >= os.stat(self.path("flatfield.npy")).st_mtime_ns
+            ):
+                return load_data(fname)
+        except FileNotFoundError:
+            pass
+
+        flat = self.flat
+        if flat.ndim != 3 or flat.shape[-1] != 3:
+            raise ValueError(f"Invalid flat field shape {flat.shape}")
+        fd, tmp = tempfile.mkstemp(suffix=".npy", dir=self.datadir)
+        with os.fdopen(fd, "wb") as f:
+            save_data(f, np.divide(flat.max((0, 1)), flat, dtype=np.float32))
+        os.replace(tmp, fname)
+        return load_data(fname)
+
+    @cached_property
+    def photometry(self):
+        photo = np.loadtxt(self.path("photometry.dat"))
+        if photo.shape != (3,):
+            raise ValueError("Invalid photometric calibration")
+        return photo
+
+    @cached_property
+    def geometry(self):
+        return Geometry.load(self.path("geometry_params.dat"))
+
+    def correct_flat(self, data, out=None):
+        return np.multiply(data, self.flat_scale, out=out)
+
+    def calibrate(self, data, exposure, out=None, block=256):
+        """Linearity, flat field and photometric calibration of a frame.
+
+        `data` must already be dark subtracted. The corrections are fused and
+        applied by blocks of `block` rows, so that the intermediate results
+        stay in cache. The result is identical to
+        `correct_flat(linearity(data)) * (photometry / exposure)`.
+        """
+        scale = self.photometry / exposure
+        if out is None:
+            out = np.empty(data.shape, dtype=np.result_type(np.float32, scale))
+        tile = np.empty((block, *data.shape[1:]), dtype=np.float32)
+        for r in range(0, data.shape[0], block):
+            rows = slice(r, r + block)
+            t = self.linearity(data[rows], out=tile[: len(data[rows])])
+            t *= self.flat_scale[rows]
+            np.multiply(t, scale, out=out[rows])
+        return out
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+#
+# LISC toolkit
+# Chunked storage of frame series
+#
+# Author : Alexandre Simoneau
+#
+# Created: October 2026
+
+import os
+import re
+
+import numpy as np
+import pandas as pd
+import yaml
+
+
+class CubeWriter:
+    """Write a series of frames to a chunked cube directory.
+
+    The cube is split in chunks of `chunks[0]` frames by `chunks[1]` rows,
+    each stored as a `.npy` file written through a memory map. If `compress`
+    is True, every completed chunk is then compressed to a `.npz` file. Only
+    one chunk is held in memory at a time while compressing. Per-frame
+    metadata is saved in `frames.csv` and the layout in `cube.yaml`.
+
+    A cube previously written to `path` is deleted when opening the writer,
+    so that an interrupted run leaves no readable mix of old and new frames.
+    """
+
+    def __init__(self, path, dtype=np.float32, chunks=(8, 64), compress=False):
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.chunks = tuple(chunks)
+        self.compress = compress
+        self.shape = None
+        self.frames = []
+        os.makedirs(path, exist_ok=True)
+        self._clear()
+
+    def _clear(self):
+        # The layout goes first, an interrupted clear leaves no readable cube
+        names = [
+            n for n in os.listdir(self.path) if re.fullmatch(r"\d+\.\d+\.np[yz]", n)
+        ]
+        for name in ["cube.yaml", "frames.csv", *names]:
+            if os.path.isfile(os.path.join(self.path, name)):
+                os.remove(os.path.join(self.path, name))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *args):
+        # An interrupted series is not made readable
+        if exc_type is None:
+            self.close()
+
+    def append(self, data, **meta):
+        if self.shape is None:
+            self.shape = data.shape
+        elif data.shape != self.shape:
+            raise ValueError(f"Frame shape {data.shape} differs from {self.shape}")
+
+        nt, nr = self.chunks
+        t, i = divmod(len(self.frames), nt)
+        for r in range(0, self.shape[0], nr):
+            fname = os.path.join(self.path, f"{t}.{r // nr}.npy")
+            if i == 0:
+                chunk = np.lib.format.open_memmap(
+                    fname, "w+", self.dtype, (nt, *data[r : r + nr].shape)
+                )
+            else:
+                chunk = np.load(fname, mmap_mode="r+")
+            chunk[i] = data[r : r + nr]
+            chunk.flush()
+            del chunk
+
+        self.frames.append(meta)
+        if i == nt - 1:
+            self._compress(t)
+
+    def _compress(self, t):
+        if not self.compress:
+            return
+        for r in range(-(-self.shape[0] // self.chunks[1])):
+            fname = os.path.join(self.path, f"{t}.{r}")
+            np.savez_compressed(fname + ".npz", data=np.load(fname + ".npy"))
+            os.remove(fname + ".npy")
+
+    def close(self):
+        if self.shape is None:
+            return
+        if len(self.frames) % self.chunks[0]:
+            self._compress(len(self.frames) // self.chunks[0])
+
+        pd.DataFrame(self.frames).to_csv(
+            os.path.join(self.path, "frames.csv"), index=False
+        )
+        meta = dict(
+            shape=[len(self.frames), *self.shape],
+            dtype=self.dtype.str,
+            chunks=list(self.chunks),
+            compressed=self.compress,
+        )
+        with open(os.path.join(self.path, "cube.yaml"), "w") as f:
+            yaml.safe_dump(meta, f)
+
+
+class Cube:
+    """Read access to a cube written by `CubeWriter`.
+
+    `cube[i]` loads a single frame and `cube.pixel(y, x)` the time series of
+    a pixel, only reading the chunks they intersect.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "cube.yaml")) as f:
+            meta = yaml.safe_load(f)
+        self.shape = tuple(meta["shape"])
+        self.dtype = np.dtype(meta["dtype"])
+        self.chunks = tuple(meta["chunks"])
+        self.compressed = meta["compressed"]
+        try:
+            self.frames = pd.read_csv(os.path.join(path, "frames.csv"))
+        except pd.errors.EmptyDataError:
+            self.frames = pd.DataFrame(index=range(self.shape[0]))
+
+    def __len__(self):
+        return self.shape[0]
+
+    def chunk(self, t, r):
+        fname = os.path.join(self.path, f"{t}.{r}")
+        if self.compressed:
+            with np.load(fname + ".npz") as f:
+                return f["data"]
+        return np.load(fname + ".npy", mmap_mode="r")
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("Frame index out of range")
+        nt, nr = self.chunks
+        t, i = divmod(i, nt)
+        return np.concatenate(
+            [self.chunk(t, r)[i] for r in range(-(-self.shape[1] // nr))]
+        )
+
+    def pixel(self, y, x):
+        nt, nr = self.chunks
+        r, y = divmod(y, nr)
+        series = np.concatenate(
+            [self.chunk(t, r)[:, y, x] for t in range(-(-len(self) // nt))]
+        )
+        return series[: len(self)]
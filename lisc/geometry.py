@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+#
+# LISC toolkit
+# Camera geometry
+#
+# Author : Alexandre Simoneau
+#
+# Created: October 2026
+
+import numpy as np
+
+
+class Geometry:
+    """Zenith angle of the pixels of a camera, computed on demand.
+
+    The angle only depends on the distance `r` to the center of the frame,
+    through `radial(arctan(pixel_size * r / focal_length))`, `radial` being
+    the polynomial fitted by `lisc starfield` (the identity if not given).
+    It is interpolated from a table of `lut_size` radii, which is accurate to
+    better than 1e-8 rad for usual lenses.
+
+    `geometry[rows, cols]` returns the angles (in radians) of a window of
+    pixels, `geometry.tiles()` iterates over blocks of rows and
+    `np.asarray(geometry)` builds the full map.
+    """
+
+    def __init__(self, shape, focal_length, pixel_size, radial=None, lut_size=4096):
+        self.shape = tuple(shape[:2])
+        self.focal_length = focal_length
+        self.pixel_size = pixel_size
+        self.radial = radial
+
+        self._radii = np.linspace(0, np.hypot(*self.shape) / 2 + 1, lut_size)
+        self._angles = self._model(self._radii)
+
+    @classmethod
+    def load(cls, fname="geometry_params.dat", **kwargs):
+        """Geometry saved by `lisc starfield`."""
+        values = dict()
+        with open(fname) as f:
+            for line in f:
+                key, *vals = line.split(",")
+                values[key.strip()] = [float(v) for v in vals]
+
+        Nx, Ny, focal_length, pixel_size = values["params"]
+        return cls(
+            (int(Ny), int(Nx)), focal_length, pixel_size, values["radial"], **kwargs
+        )
+
+    @classmethod
+    def pinhole(cls, shape, params, **kwargs):
+        """Geometry of an ideal lens described by the camera `params`."""
+        return cls(
+            shape, params["focal_length"], params["pixel_size"] / 1000 * 2, **kwargs
+        )
+
+    def _model(self, r):
+        alt = np.arctan(self.pixel_size * r / self.focal_length)
+        if self.radial is None:
+            return alt
+        b, c, d, e = self.radial
+        return b * alt + c * alt**2 + d * alt**3 + e * alt**4
+
+    def zenith_angle(self, r):
+        """Zenith angle at a distance of `r` pixels from the center."""
+        return np.interp(r, self._radii, self._angles)
+
+    def radius(self, angle):
+        """Distance from the center at which the zenith angle is `angle`."""
+        return np.interp(angle, self._angles, self._radii)
+
+    def __getitem__(self, key):
+        rows, cols = key
+        Ny, Nx = self.shape
+        y = Ny / 2 - np.arange(Ny)[rows] + 0.5
+        x = np.arange(Nx)[cols] - Nx / 2 + 0.5
+        return self.zenith_angle(np.sqrt(np.add.outer(y**2, x**2)))
+
+    def tiles(self, rows=256):
+        """Iterate over the row slices of the frame and their angles."""
+        for r in range(0, self.shape[0], rows):
+            tile = slice(r, min(r + rows, self.shape[0]))
+            yield tile, self[tile, :]
+
+    def __array__(self, dtype=None, copy=None):
+        return np.asarray(self[:, :], dtype=dtype)
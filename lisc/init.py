@@ -16,6 +16,7 @@ import click
 import pandas as pd
 import yaml
 
+from .camera import CameraCalibration
 from .utils import exif_read
 
 
@@ -149,7 +150,7 @@ def save():
     "Saves calibration files"
     datafiles = [
         "params",
-        "geometry.npy",
+        "geometry_params.dat",
         "linearity.csv",
         "flatfield.npy",
         "flat_weight.npy",
@@ -192,9 +193,12 @@ def save():
 def list():
     "List calibrated cameras"
 
-    for param_file in glob(os.path.expanduser("~/.LISC/*/params")):
-        with open(param_file) as f:
-            params = yaml.safe_load(f)
+    for cam_key in CameraCalibration.available():
+        try:
+            params = CameraCalibration.load(cam_key).params
+        except FileNotFoundError as err:
+            print(f"WARNING: {err}\n")
+            continue
 
         print(
             f"{params['camera_reference_name']}\n"
@@ -40,9 +40,23 @@ for module_name, method in functions:
 @click.option(
     "-f",
     "--format",
-    type=click.Choice(["NPY", "TIF"], case_sensitive=False),
+    type=click.Choice(["NPY", "TIF", "CUBE"], case_sensitive=False),
     default="NPY",
-    help="Converted file format. (Default: NPY)",
+    help="Converted file format. CUBE writes all frames to a single chunked "
+    "cube. (Default: NPY)",
+)
+@click.option(
+    "-o",
+    "--output",
+    type=click.Path(),
+    default="calibrated.cube",
+    help="Output path for the CUBE format. (Default: calibrated.cube)",
+)
+@click.option(
+    "-c",
+    "--compress",
+    is_flag=True,
+    help="Compress the chunks of the CUBE format.",
 )
 @click.option(
     "-s",
@@ -51,14 +65,38 @@ for module_name, method in functions:
     default=5,
     help="Standard deviation used for cosmicray filtering. (Default: 5)",
 )
-def calib(cam_key, images, darks, format, sigma):
+@click.option(
+    "-j",
+    "--jobs",
+    type=int,
+    default=1,
+    help="Number of worker processes. Use 0 for all cores. (Default: 1)",
+)
+@click.option(
+    "--cr-jobs",
+    type=int,
+    default=1,
+    help="Number of threads for the tiled cosmicray filtering of each image. "
+    "Use 0 for all cores. (Default: 1)",
+)
+@click.option(
+    "--cr-prefilter",
+    type=float,
+    help="Only apply cosmicray filtering to tiles containing pixels exceeding "
+    "their neighbours by this fraction of SIGMA times the noise. The number of "
+    "skipped tiles is reported.",
+)
+def calib(
+    cam_key, images, darks, format, sigma, jobs, cr_jobs, cr_prefilter, output, compress
+):
     """Image calibration pipeline.
 
     CAM_KEY: Camera key for calibration. See the available options with `lisc
     list`.\n
     IMAGES: Image to convert. Altenatively, one can process multiple images by
     passing a string containing a wildcard.\n
-    DARKS: Dark images to use for calibration.
+    DARKS: Dark images to use for calibration. If omitted, the closest master
+    dark of the library taken with the same camera and ISO is used.
     """
     lisc.calib.calib(
         cam_key,
@@ -66,6 +104,11 @@ def calib(cam_key, images, darks, format, sigma):
         darks,
         fmt=format.lower(),
         sigclip=sigma,
+        jobs=jobs,
+        output=output,
+        compress=compress,
+        cr_jobs=cr_jobs,
+        cr_prefilter=cr_prefilter,
     )
     print("Done.")
 
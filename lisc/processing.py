@@ -1,17 +1,20 @@
 #!/usr/bin/env python3
 
 import os
+from glob import glob
 
 import click
 import imageio
+import joblib
 import numpy as np
 import pandas as pd
 
 import lisc.utils
+from lisc.cube import CubeWriter
 
 
 @click.command()
-@click.argument("filename", type=click.Path(exists=True))
+@click.argument("filenames", nargs=-1, required=True)
 @click.option(
     "-p",
     "--percentile",
@@ -20,33 +23,272 @@ import lisc.utils
     multiple=True,
     help="The percentile value to extract. Can be specified multiple times.",
 )
-def perc(filename, percentile):
-    """Extract percentile from images"""
+@click.option(
+    "-m",
+    "--method",
+    type=click.Choice(["partition", "histogram"], case_sensitive=False),
+    default="partition",
+    help="Selection method. 'histogram' requires integer images and reads raw "
+    "files as ADU values, the green band being the average of the two green "
+    "pixels rounded down. (Default: partition)",
+)
+@click.option(
+    "-j",
+    "--jobs",
+    type=int,
+    default=1,
+    help="Number of worker processes. Use 0 for all cores. (Default: 1)",
+)
+@click.option(
+    "-o",
+    "--output",
+    type=click.Path(),
+    help="Write the table to this CSV or Parquet (.parquet) file instead of "
+    "printing it.",
+)
+@click.option(
+    "-a",
+    "--aggregate",
+    is_flag=True,
+    help="Report the percentiles of all the images combined, from their merged "
+    "histograms. Raw and integer images are binned by value, as with '-m "
+    "histogram', calibrated (float) images require --range.",
+)
+@click.option(
+    "--histogram",
+    type=click.Path(),
+    help="With --aggregate, histogram file (.npz) merged with the images and "
+    "updated, to aggregate over several runs.",
+)
+@click.option(
+    "--range",
+    "value_range",
+    nargs=2,
+    type=float,
+    help="With --aggregate, range of values binned, for float images. The "
+    "percentiles are accurate to half a bin.",
+)
+@click.option(
+    "--bins",
+    type=int,
+    default=2**16,
+    help="With --aggregate and --range, number of bins. (Default: 65536)",
+)
+def perc(
+    filenames,
+    percentile,
+    method,
+    jobs,
+    output,
+    aggregate,
+    histogram,
+    value_range,
+    bins,
+):
+    """Extract percentile from images
+
+    FILENAMES: Images to process. Strings containing a wildcard are expanded.
+    """
     percentile = np.asarray(sorted(percentile, reverse=True))
     if np.all(percentile < 1):
         print("WARNING: All percentiles below 1. Expected to be in [0:100].")
 
+    fnames = []
+    for pattern in filenames:
+        fnames += sorted(glob(os.path.expanduser(pattern))) or [pattern]
+    missing = [fname for fname in fnames if not os.path.isfile(fname)]
+    if missing:
+        print(f"ERROR: No such file: {', '.join(missing)}")
+        return
+
+    n_jobs = jobs if jobs > 0 else -1
+    if aggregate:
+        if histogram is not None and not histogram.endswith(".npz"):
+            histogram += ".npz"
+        try:
+            df = _aggregate(fnames, percentile, n_jobs, histogram, value_range, bins)
+        except (TypeError, ValueError) as err:
+            print(f"ERROR: {err}")
+            return
+        _write_table(df, output)
+        return
+
+    method = method.lower()
+    try:
+        results = joblib.Parallel(n_jobs=n_jobs)(
+            joblib.delayed(_percentiles)(fname, percentile, method) for fname in fnames
+        )
+    except (TypeError, ValueError) as err:
+        print(f"ERROR: {err}")
+        return
+
+    df = pd.concat(
+        [
+            pd.DataFrame(dict(Filename=fname, Percentile=percentile, **_bands(p)))
+            for fname, p in zip(fnames, results)
+        ],
+        ignore_index=True,
+    )
+    _write_table(df, output)
+
+
+def _bands(p):
+    """Columns of the percentiles of each band, or of a single band image."""
+    if p.shape[1] == 1:
+        return dict(Value=p[:, 0])
+    if p.shape[1] != 3:
+        raise ValueError(f"Expected 1 or 3 bands, got {p.shape[1]}")
+    return dict(R=p[:, 0], G=p[:, 1], B=p[:, 2])
+
+
+def _write_table(df, output):
+    if output is None:
+        print(df.to_string(index=False))
+    elif output.endswith(".parquet"):
+        try:
+            df.to_parquet(output, index=False)
+        except ImportError as err:
+            print(f"ERROR: {err}")
+    else:
+        df.to_csv(output, index=False)
+
+
+def _aggregate(
+    fnames, percentile, n_jobs, histogram=None, value_range=None, bins=2**16
+):
+    # Each worker builds the histogram of a chunk of files
+    hists = joblib.Parallel(n_jobs=n_jobs)(
+        joblib.delayed(_histogram)(chunk, value_range, bins)
+        for chunk in lisc.utils.split_jobs(fnames, n_jobs)
+    )
+    if histogram is not None and os.path.isfile(histogram):
+        hists.append(lisc.utils.Histogram.load(histogram))
+
+    hist = hists[0]
+    for other in hists[1:]:
+        hist += other
+    if histogram is not None:
+        hist.save(histogram)
+
+    print(f"Aggregated {hist.frames} frames")
+    p = hist.percentile(percentile)
+    return pd.DataFrame(dict(Percentile=percentile, **_bands(p)))
+
+
+def _histogram(fnames, value_range=None, bins=2**16):
+    hist = None
+    for fname in fnames:
+        im = _open_image(fname, np.uint16)
+        if value_range is None and im.dtype.kind not in "iu":
+            raise ValueError(f"{fname} is not an integer image, use --range")
+        if hist is None:
+            bands = im.shape[-1] if im.ndim == 3 else 1
+            if value_range is None:
+                hist = lisc.utils.Histogram(bands)
+            else:
+                hist = lisc.utils.Histogram(bands, bins, value_range)
+        hist.update(im)
+    return hist
+
+
+def _open_image(fname, dtype):
+    if fname.lower().endswith(".npy"):
+        return np.load(fname, mmap_mode="r")
     try:
-        im = lisc.utils.open_raw(filename)
+        return lisc.utils.open_raw(fname, dtype=dtype)
     except TypeError as err:
         try:
-            im = imageio.imread(filename)
+            return imageio.imread(fname)
         except OSError:
-            raise err
+            raise TypeError(f"{fname}: {err}")
 
-    perc = np.percentile(im, percentile, (0, 1))
 
-    if len(perc) == 1:
-        print(f"R = {perc[0,0]:.2g}    G = {perc[0,1]:.2g}    B = {perc[0,2]:.2g}")
-    else:
-        print(pd.DataFrame(perc, index=percentile, columns=["R", "G", "B"]))
+def _percentiles(fname, percentile, method):
+    im = _open_image(fname, np.uint16 if method == "histogram" else np.float32)
+
+    if method == "histogram":
+        if im.dtype.kind not in "iu":
+            raise ValueError(f"{fname} is not an integer image, use -m partition")
+        return lisc.utils.percentile_histogram(im, percentile)
+    return lisc.utils.percentile_partition(im, percentile)
 
 
 @click.command()
-@click.argument("filename", type=click.Path(exists=True))
+@click.argument("images")
 @click.argument("weights", nargs=3, type=float, default=[1 / 3, 1 / 3, 1 / 3])
-def gray(filename, weights):
-    im = imageio.imread(filename)
-    gr = np.dot(im, weights)
-    name, ext = os.path.splitext(filename)
-    imageio.imwrite("".join([name, "_gr", ext]), gr)
+@click.option(
+    "-j",
+    "--jobs",
+    type=int,
+    default=1,
+    help="Number of worker processes. Use 0 for all cores. (Default: 1)",
+)
+@click.option(
+    "--cube",
+    type=click.Path(),
+    help="Write all the converted images to this single chunked cube instead "
+    "of one file per image.",
+)
+def gray(images, weights, jobs, cube):
+    """Convert images to grayscale.
+
+    IMAGES: Image to convert, either TIFF, NPY or raw. Alternatively, one can
+    process multiple images by passing a string containing a wildcard.\n
+    WEIGHTS: Weights of the R, G and B bands. (Default: 1/3 1/3 1/3)
+
+    The converted images are saved as float32 next to the original, with a
+    '_gr' suffix (NPY for raw images).
+    """
+    fnames = sorted(glob(os.path.expanduser(images)))
+    if not fnames:
+        print(f"ERROR: No image matching '{images}'.")
+        return
+    n_jobs = jobs if jobs > 0 else -1
+
+    # Images that are not in color, such as previous outputs, are skipped
+    if cube is None:
+        results = joblib.Parallel(n_jobs=n_jobs)(
+            joblib.delayed(_gray)(fname, weights, save=True) for fname in fnames
+        )
+        for fname, out in zip(fnames, results):
+            if out is None:
+                print(f"WARNING: Skipped '{fname}', not a color image.")
+        return
+
+    results = joblib.Parallel(n_jobs=n_jobs, return_as="generator")(
+        joblib.delayed(_gray)(fname, weights) for fname in fnames
+    )
+    with CubeWriter(cube) as writer:
+        for fname, gr in zip(fnames, results):
+            if gr is None:
+                print(f"WARNING: Skipped '{fname}', not a color image.")
+                continue
+            writer.append(gr, Filename=os.path.basename(fname))
+
+
+def _gray(fname, weights, save=False, block=256):
+    """Grayscale image of `fname`, or the name of the file it is saved to.
+
+    Returns None if `fname` is not a color image.
+    """
+    im = _open_image(fname, np.float32)
+    if im.ndim != 3:
+        return None
+    weights = np.asarray(weights, dtype=np.float32)
+
+    # Converted by blocks of rows, to only read memory mapped inputs once
+    gr = np.empty(im.shape[:2], dtype=np.float32)
+    for r in range(0, im.shape[0], block):
+        gr[r : r + block] = np.asarray(im[r : r + block], dtype=np.float32) @ weights
+
+    if not save:
+        return gr
+
+    name, ext = os.path.splitext(fname)
+    if ext.lower() in [".npy", ".arw", ".dng"]:
+        out = f"{name}_gr.npy"
+        np.save(out, gr)
+    else:
+        out = f"{name}_gr{ext}"
+        imageio.imwrite(out, gr)
+    return out
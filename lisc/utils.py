@@ -8,52 +8,177 @@ import pandas as _pd
 import rawpy as _rawpy
 from astroscrappy import detect_cosmics as _detect_cosmics
 from scipy.ndimage import gaussian_filter as _gaussian_filter
+from scipy.ndimage import laplace as _laplace
+from scipy.signal import lfilter as _lfilter
 
+from .cache import dark_library as _dark_library
+from .cache import raw_cache as _raw_cache
+
+
+def parallelize(func=None, prefer="threads"):
+    """Map a function over an iterable on all cores.
+
+    Used as `@parallelize` for threads or `@parallelize(prefer="processes")`.
+    """
+    if func is None:
+        return lambda func: parallelize(func, prefer)
 
-def parallelize(func):
     def wrapper(iterable, *args):
-        return _joblib.Parallel(n_jobs=-1, prefer="threads")(
+        return _joblib.Parallel(n_jobs=-1, prefer=prefer)(
             _joblib.delayed(func)(i, *args) for i in iterable
         )
 
     return wrapper
 
 
-def open_raw(fname, band_list="RGB"):
+def split_jobs(items, n_jobs=-1):
+    """Split `items` in one contiguous chunk per job."""
+    n_chunks = max(1, min(_joblib.effective_n_jobs(n_jobs), len(items)))
+    bounds = _np.linspace(0, len(items), n_chunks + 1).astype(int)
+    return [items[i:j] for i, j in zip(bounds[:-1], bounds[1:])]
+
+
+def open_raw(
+    fname, band_list="RGB", cache=False, dtype=_np.float32, out=None, roi=None
+):
+    """Open a raw image as a half resolution array of `band_list` bands.
+
+    Each band is written directly into `out` (or a new array) in a single
+    pass over the Bayer planes of the same color, averaging them. Floating
+    point `dtype` are normalized by the white level. Integer `dtype` keep
+    the native ADU values, averaged planes being rounded down.
+
+    If `roi` is given as a pair of row and column slices, only that window of
+    the half resolution frame is converted.
+
+    If `cache` is True, the decoded frame is read from or saved to the on-disk
+    frame cache and returned as a copy-on-write memory map.
+    """
+    dtype = _np.dtype(dtype)
+    if cache:
+        extra = [] if roi is None else [[(s.start, s.stop) for s in roi]]
+        data = _raw_cache.load(
+            fname,
+            lambda: open_raw(fname, band_list, dtype=dtype, roi=roi),
+            "open_raw",
+            band_list,
+            dtype.str,
+            *extra,
+        )
+        if out is not None:
+            out[...] = data
+            return out
+        return data
+
     try:
         raw = _rawpy.imread(fname)
     except _rawpy.LibRawFileUnsupportedError:
         raise TypeError("Unsupported file format")
 
-    h = raw.sizes.height // 2
-    w = raw.sizes.width // 2
+    with raw:
+        h = raw.sizes.height // 2
+        w = raw.sizes.width // 2
+        image = raw.raw_image_visible
+        colors = raw.color_desc.decode()
+        pattern = raw.raw_pattern
+
+        if roi is None:
+            roi = (slice(None), slice(None))
+        r0, r1, _ = roi[0].indices(h)
+        c0, c1, _ = roi[1].indices(w)
+        if out is None:
+            out = _np.empty((r1 - r0, c1 - c0, len(band_list)), dtype=dtype)
+
+        for dst, band in zip(_np.moveaxis(out, -1, 0), band_list):
+            planes = [
+                image[2 * r0 + i : 2 * r1 : 2, 2 * c0 + j : 2 * c1 : 2]
+                for i in range(2)
+                for j in range(2)
+                if colors[pattern[i, j]] == band
+            ]
+            if not planes:
+                raise ValueError(f"Band '{band}' not found in '{colors}'")
+
+            if out.dtype.kind in "iu":
+                if len(planes) == 1:
+                    dst[...] = planes[0]
+                    continue
+                acc = _np.add(planes[0], planes[1], dtype=_np.uint32)
+                for plane in planes[2:]:
+                    acc += plane
+                _np.floor_divide(acc, len(planes), out=dst, casting="unsafe")
+            else:
+                if len(planes) == 1:
+                    dst[...] = planes[0]
+                else:
+                    _np.add(planes[0], planes[1], out=dst, dtype=dst.dtype)
+                    for plane in planes[2:]:
+                        dst += plane
+                dst *= 1 / (len(planes) * raw.white_level)
 
-    data = (
-        raw.raw_image_visible.reshape(h, 2, w, 2)
-        .transpose((1, 3, 0, 2))
-        .reshape(4, h, w)
-    ) / raw.white_level
+    return out
 
-    bands_mask = (
-        _np.array(list(raw.color_desc.decode()))[raw.raw_pattern.flatten()]
-        == _np.array(list(band_list))[:, None]
-    )
 
-    return _np.stack(
-        [_np.mean(data[b], axis=0) if sum(b) > 1 else data[b][0] for b in bands_mask],
-        axis=-1,
+def raw_shape(fname, band_list="RGB"):
+    """Shape of the array returned by `open_raw`, without decoding the frame."""
+    try:
+        with _rawpy.imread(fname) as raw:
+            return (raw.sizes.height // 2, raw.sizes.width // 2, len(band_list))
+    except _rawpy.LibRawFileUnsupportedError:
+        raise TypeError("Unsupported file format")
+
+
+def cache_raw(fnames, n_jobs=-1):
+    """Decode frames to the frame cache in parallel worker processes."""
+    _joblib.Parallel(n_jobs=n_jobs)(_joblib.delayed(_cache_raw)(f) for f in fnames)
+
+
+def _cache_raw(fname):
+    open_raw(fname, cache=True)
+
+
+def iter_raw(fnames, n_jobs=-1):
+    """Iterate over frames opened with `open_raw(fname, cache=True)`.
+
+    The frames are decoded to the frame cache in worker processes, at most two
+    per worker ahead of the frame being read, so that any number of frames can
+    be read without exceeding the cache.
+    """
+    decoded = _joblib.Parallel(n_jobs=n_jobs, return_as="generator")(
+        _joblib.delayed(_cache_raw)(f) for f in fnames
     )
+    for fname, _ in zip(fnames, decoded):
+        yield open_raw(fname, cache=True)
 
 
 def exif_read(fname, raw=False):
+    return exif_read_many([fname], raw)[0]
+
+
+def exif_read_many(fnames, raw=False):
+    """Read the metadata of many files in a single ExifTool session."""
+    fnames = list(fnames)
+    if not fnames:
+        return []
+
     with _exiftool.ExifToolHelper() as et:
-        exif = et.get_metadata(fname)[0]
+        exifs = et.get_metadata(fnames)
 
     if raw:
-        return exif
+        return exifs
+
+    return [_exif_normalize(exif) for exif in exifs]
 
+
+def exif_camera(exif):
+    """Camera identifier of normalized metadata."""
+    return f"{exif['Make']} {exif['Model']}"
+
+
+def _exif_normalize(exif):
     gen = [
         "BitsPerSample",
+        "DateTimeOriginal",
         "ExposureTime",
         "ISO",
         "LensModel",
@@ -62,6 +187,11 @@ def exif_read(fname, raw=False):
         "ShutterSpeedValue",
     ]
     keys = {k: "EXIF:" + k for k in gen}
+    keys["Temperature"] = (
+        "EXIF:AmbientTemperature",
+        "MakerNotes:AmbientTemperature",
+        "MakerNotes:CameraTemperature",
+    )
 
     make = exif[keys["Make"]]
     if make == "SONY":
@@ -106,69 +236,309 @@ def exif_read(fname, raw=False):
     return info
 
 
-def compute_stats(fnames):
-    # Taken from
-    # https://en.wikipedia.org/wiki/Algorithms_for_calculating_variance
-    def _update(existingAggregate, newValue):
-        (count, mean, M2) = existingAggregate
-        count += 1
-        delta = newValue - mean
-        mean += delta / count
-        delta2 = newValue - mean
-        M2 += delta * delta2
-        return (count, mean, M2)
-
-    def _finalize(existingAggregate):
-        (count, mean, M2) = existingAggregate
-        return (mean, M2 / count)
-
-    rgb = open_raw(fnames[0])
-    aggregate = (1, rgb, _np.zeros_like(rgb))
-    for fname in fnames[1:]:
-        rgb = open_raw(fname)
-        aggregate = _update(aggregate, rgb)
-    mean, variance = _finalize(aggregate)
-    return mean, _np.sqrt(variance)
+def compute_stats(fnames, n_jobs=-1):
+    """Pixel-wise mean and standard deviation of frames.
+
+    The frames are split in `n_jobs` chunks reduced in parallel with Welford's
+    algorithm, the partial aggregates are then merged with the formula of
+    Chan et al. See
+    https://en.wikipedia.org/wiki/Algorithms_for_calculating_variance
+    """
+    chunks = split_jobs(fnames, n_jobs)
+    if len(chunks) > 1:
+        aggregates = _joblib.Parallel(n_jobs=len(chunks))(
+            _joblib.delayed(_welford)(chunk) for chunk in chunks
+        )
+    else:
+        aggregates = [_welford(fnames)]
+
+    aggregate = aggregates[0]
+    for other in aggregates[1:]:
+        aggregate = _welford_merge(aggregate, other)
 
+    count, mean, M2 = aggregate
+    M2 /= count
+    return mean, _np.sqrt(M2, out=M2)
 
-def open_clipped(fnames, mean=None, stdev=None, sigclip=5):
-    basename = ""
+
+def _welford(fnames):
+    rgb = open_raw(fnames[0], cache=True)
+    count = 1
+    mean = _np.array(rgb, dtype=_np.float64)
+    M2 = _np.zeros_like(mean)
+    delta = _np.empty_like(mean)
+    delta2 = _np.empty_like(mean)
+    for fname in fnames[1:]:
+        rgb = open_raw(fname, cache=True)
+        count += 1
+        _np.subtract(rgb, mean, out=delta)
+        _np.divide(delta, count, out=delta2)
+        mean += delta2
+        _np.subtract(rgb, mean, out=delta2)
+        delta2 *= delta
+        M2 += delta2
+    return count, mean, M2
+
+
+def _welford_merge(aggregate, other):
+    # Modifies both aggregates in place
+    count_a, mean_a, M2_a = aggregate
+    count_b, mean_b, M2_b = other
+    count = count_a + count_b
+
+    delta = _np.subtract(mean_b, mean_a, out=mean_b)
+    M2_a += M2_b
+    mean_a += _np.multiply(delta, count_b / count, out=M2_b)
+    delta *= delta
+    delta *= count_a * count_b / count
+    M2_a += delta
+    return count, mean_a, M2_a
+
+
+def open_clipped(fnames, mean=None, stdev=None, sigclip=5, library=True):
+    """Sigma-clipped mean of frames.
+
+    Unless `mean` and `stdev` are given or `library` is False, the result is
+    read from or saved to the master dark library.
+    """
     if type(fnames) == str:
-        basename = fnames.replace("*", "$").replace("?", "&").replace(".", "!") + ".npy"
-        if _os.path.isfile(basename):
-            print(f"Opening {fnames} from cache")
-            return _np.load(basename)
         fnames = glob_types(fnames)
 
+    if mean is not None and stdev is not None:
+        return _stack_stream(fnames, sigclip, mean, stdev)
+    if not library:
+        return stack_frames(fnames, sigclip=sigclip)
+
+    return _dark_library.load(master_dark(fnames, sigclip))
+
+
+def master_dark(fnames, sigclip=5):
+    """Library key of the master dark of `fnames`, computed if needed."""
+    key = _dark_library.key(fnames, sigclip)
+    if _os.path.isfile(_dark_library.filename(key)):
+        print("Opening master dark from library")
+        return key
+
+    out = stack_frames(fnames, sigclip=sigclip)
+    exifs = exif_read_many(fnames)
+    if type(exifs[0]["ShutterSpeedValue"]) == str:
+        print("WARNING: Unknown exposure of the darks, not indexed in the library")
+    temps = [e["Temperature"] for e in exifs if type(e["Temperature"]) != str]
+    _dark_library.store(
+        key,
+        out,
+        camera=exif_camera(exifs[0]),
+        shape=out.shape,
+        exposure=exifs[0]["ShutterSpeedValue"],
+        iso=exifs[0]["ISO"],
+        temperature=_np.mean(temps) if temps else _np.nan,
+        sigclip=sigclip,
+        nframes=len(fnames),
+    )
+    return key
+
+
+def stack_frames(
+    fnames,
+    method="clip",
+    sigclip=5,
+    iters=1,
+    mode="chunked",
+    chunk=4,
+    roi=None,
+    n_jobs=-1,
+):
+    """Combine frames pixel by pixel.
+
+    `method` is one of 'mean', 'median' or 'clip' (sigma-clipped mean, with
+    `iters` clipping iterations). Clipped means are normalized by the number
+    of valid samples of each pixel.
+
+    In 'chunked' mode, the frames are decoded once to the frame cache by
+    `n_jobs` worker processes and combined by blocks of rows on `n_jobs`
+    threads, the blocks in flight holding about `chunk` frames worth of data.
+    In 'stream' mode, whole frames are accumulated one at a time in two passes
+    (statistics, then clipping). It only supports single iteration 'clip' and
+    'mean'. Either way, peak memory is a few frames.
+
+    If `roi` is given, only that window of the frames is decoded, see
+    `open_raw`. The windows are held in memory and combined in 'chunked' mode.
+    """
+    if method not in ["mean", "median", "clip"]:
+        raise ValueError(f"Unknown stacking method '{method}'")
+    if mode not in ["chunked", "stream"]:
+        raise ValueError(f"Unknown stacking mode '{mode}'")
+
+    if mode == "stream" and roi is None:
+        if method == "median" or iters != 1:
+            raise ValueError("Stream mode only supports single pass combining")
+        return _stack_stream(fnames, sigclip if method == "clip" else _np.inf)
+
+    print("Stacking files...")
+    if roi is None:
+        frames = list(iter_raw(fnames, n_jobs))
+    else:
+        frames = [open_raw(fname, roi=roi) for fname in fnames]
+    out = _np.empty(frames[0].shape, frames[0].dtype)
+    n_threads = _joblib.effective_n_jobs(n_jobs)
+    rows = max(1, chunk * out.shape[0] // (len(frames) * n_threads))
+    _joblib.Parallel(n_jobs=n_jobs, prefer="threads")(
+        _joblib.delayed(_stack_rows)(
+            frames, out, slice(r, r + rows), method, sigclip, iters
+        )
+        for r in range(0, out.shape[0], rows)
+    )
+    return out
+
+
+def _stack_rows(frames, out, rows, method, sigclip, iters):
+    block = _np.stack([frame[rows] for frame in frames])
+    if method == "median":
+        out[rows] = _np.median(block, 0)
+        return
+    if method == "clip":
+        for i in range(iters):
+            clip = (
+                _np.abs(block - _np.nanmean(block, 0)) > _np.nanstd(block, 0) * sigclip
+            )
+            if not clip.any():
+                break
+            block[clip] = _np.nan
+    out[rows] = _np.nanmean(block, 0)
+
+
+def _stack_stream(fnames, sigclip, mean=None, stdev=None):
     if mean is None or stdev is None:
         print("Computing statistics...")
         mean, stdev = compute_stats(fnames)
 
     print("Clipping files...")
-    arr = _np.zeros_like(mean)
-    for fname in fnames:
-        rgb = open_raw(fname)
-        rgb[_np.abs(rgb - mean) > stdev * sigclip] = _np.nan
-        arr = _np.nansum([arr, rgb], 0)
-    out = arr / len(fnames)
+    threshold = stdev * sigclip
+    total = _np.zeros_like(mean)
+    count = _np.zeros(mean.shape, dtype=_np.int32)
+    dist = _np.empty_like(mean)
+    valid = _np.empty(mean.shape, dtype=bool)
+    for rgb in iter_raw(fnames):
+        _np.subtract(rgb, mean, out=dist)
+        _np.abs(dist, out=dist)
+        _np.less_equal(dist, threshold, out=valid)
+        _np.add(total, rgb, out=total, where=valid)
+        count += valid
+    _np.divide(total, count, out=total, where=count > 0)
+    total[count == 0] = _np.nan
+    return total
+
+
+def cosmicray_removal(
+    image,
+    out=None,
+    tile=None,
+    halo=None,
+    n_jobs=1,
+    prefilter=None,
+    stats=None,
+    **kwargs,
+):
+    """Remove cosmic rays from each band of `image`.
+
+    The cleaned bands are written to `out` if given, which may be `image`.
+
+    If `tile` is given, the bands are split in tiles of `tile` by `tile`
+    pixels, each processed with a margin of `halo` pixels (8 per iteration by
+    default) and stitched back together. Bands and tiles are processed on
+    `n_jobs` threads.
+
+    If `prefilter` is given, tiles without any pixel exceeding the mean of
+    its neighbours by `prefilter * sigclip` times the noise are left as is
+    instead of going through L.A.Cosmic. The number of tiles processed and
+    skipped is added to the `stats` dictionary, if given.
+    """
+    if "sigclip" not in kwargs:
+        kwargs["sigclip"] = 25
+    if halo is None:
+        halo = 8 * kwargs.get("niter", 4)
+    if out is None:
+        out = _np.empty(image.shape, dtype=_np.float32)
+    if image.ndim == 2:
+        cosmicray_removal(
+            image[..., None],
+            out[..., None],
+            tile,
+            halo,
+            n_jobs,
+            prefilter,
+            stats,
+            **kwargs,
+        )
+        return out
 
-    if basename:
-        _np.save(basename, out)
+    tasks = [
+        (b, inner, outer)
+        for b in range(image.shape[-1])
+        for inner, outer in _tiles(image.shape[:2], tile, halo)
+    ]
+    # Tiles are cleaned from the input, so `out` must only be written at the end
+    cleaned = _joblib.Parallel(n_jobs=n_jobs, prefer="threads")(
+        _joblib.delayed(_clean_tile)(image[..., b], inner, outer, prefilter, kwargs)
+        for b, inner, outer in tasks
+    )
+    for (b, inner, outer), data in zip(tasks, cleaned):
+        if data is None:
+            out[inner + (b,)] = image[inner + (b,)]
+        else:
+            out[inner + (b,)] = data
 
+    if stats is not None:
+        skipped = sum(data is None for data in cleaned)
+        stats["tiles"] = stats.get("tiles", 0) + len(tasks)
+        stats["skipped"] = stats.get("skipped", 0) + skipped
     return out
 
 
-def cosmicray_removal(image, **kwargs):
-    if "sigclip" not in kwargs:
-        kwargs["sigclip"] = 25
-    if image.ndim == 3:
-        new_data = _np.stack(
-            [_detect_cosmics(band, **kwargs)[1] for band in _np.moveaxis(image, -1, 0)],
-            axis=2,
-        )
-    else:
-        new_data = _detect_cosmics(image, **kwargs)[1]
-    return new_data
+def _clean_tile(band, inner, outer, prefilter, kwargs):
+    if prefilter is not None and not _cr_candidates(band, inner, prefilter, kwargs):
+        return None
+    local = tuple(
+        slice(i.start - o.start, i.stop - o.start) for i, o in zip(inner, outer)
+    )
+    return _detect_cosmics(band[outer], **kwargs)[1][local]
+
+
+def _cr_candidates(band, inner, prefilter, kwargs):
+    """Whether a tile may contain cosmic rays.
+
+    The Laplacian of the tile, grown by the 2 pixels that L.A.Cosmic may
+    mask around a hit, is compared to the noise of its faintest pixels.
+    """
+    grown = tuple(
+        slice(max(i.start - 3, 0), min(i.stop + 3, n))
+        for i, n in zip(inner, band.shape)
+    )
+    data = _np.asarray(band[grown], dtype=_np.float32)
+    lap = -_laplace(data, mode="nearest") / 4
+
+    gain = kwargs.get("gain", 1.0)
+    readnoise = kwargs.get("readnoise", 6.5)
+    level = max(_np.percentile(data, 1), 0)
+    noise = _np.sqrt(level * gain + readnoise**2) / gain
+    return _np.any(lap > prefilter * kwargs["sigclip"] * noise)
+
+
+def _tiles(shape, tile, halo):
+    """Slices of the tiles covering `shape`, without and with their halo."""
+    if tile is None:
+        tile, halo = max(shape), 0
+    for r in range(0, shape[0], tile):
+        for c in range(0, shape[1], tile):
+            inner = (
+                slice(r, min(r + tile, shape[0])),
+                slice(c, min(c + tile, shape[1])),
+            )
+            outer = tuple(
+                slice(max(i.start - halo, 0), min(i.stop + halo, n))
+                for i, n in zip(inner, shape)
+            )
+            yield inner, outer
 
 
 def cycle_mod(x, a=2 * _np.pi):
@@ -184,67 +554,331 @@ def glob_types(pattern="*", types=None):
 
 def circle_mask(x, y, shape, r):
     Y, X = _np.ogrid[: shape[0], : shape[1]]
-    return (X - x) ** 2 + (Y - y) ** 2 < r ** 2
+    return (X - x) ** 2 + (Y - y) ** 2 < r**2
 
 
-def blur_image(image, blur_radius=25):
+def blur_image(image, blur_radius=25, method="exact", tol=1e-3):
     """Apply a gaussian filter to an array with nans.
-    Based on code from David of StackOverflow:
+
+    The bands are filtered together along the spatial axes, normalized by
+    the filtered mask of valid pixels, which is shared by all the bands when
+    their nans coincide. Based on code from David of StackOverflow:
         https://stackoverflow.com/a/36307291/7128154
-    """
-    gauss = image.copy()
-    gauss[_np.isnan(gauss)] = 0
-    gauss = _np.stack(
-        [
-            _gaussian_filter(band, blur_radius, mode="constant", cval=0)
-            for band in _np.moveaxis(gauss, -1, 0)
-        ],
-        axis=2,
-    )
 
-    norm = _np.ones(shape=image.shape)
-    norm[_np.isnan(image)] = 0
-    norm = _np.stack(
-        [
-            _gaussian_filter(band, blur_radius, mode="constant", cval=0)
-            for band in _np.moveaxis(norm, -1, 0)
-        ],
-        axis=2,
-    )
+    `method` can be 'exact', 'downsample' or 'iir'. 'downsample' blurs a
+    block averaged copy of the image, the block size being chosen to keep the
+    error below `tol` times the range of the image (measured on noise, steps
+    and sinusoids of any period, patterns repeating every block can exceed
+    it). 'iir' uses the recursive filter of Deriche, whose error is below
+    0.1% of the range of the image away from the edges and nans, and below 1%
+    up to the corners. Both are much faster for large radii.
+    """
+    blur = dict(exact=_blur_exact, downsample=_blur_downsample, iir=_blur_iir)
+    if method not in blur:
+        raise ValueError(f"Unknown blur method '{method}'")
+    blur = blur[method]
+
+    nans = _np.isnan(image)
+    gauss = blur(_np.where(nans, 0, image), blur_radius, tol)
+    if not nans.any():
+        mask = _np.ones(image.shape[:2])
+    elif image.ndim == 3 and (nans == nans[..., :1]).all():
+        mask = (~nans[..., 0]).astype(float)
+    else:
+        mask = (~nans).astype(float)
+    norm = blur(mask, blur_radius, tol)
+    if norm.ndim < gauss.ndim:
+        norm = norm[..., None]
 
     # avoid RuntimeWarning: invalid value encountered in true_divide
     norm = _np.where(norm == 0, 1, norm)
     gauss = gauss / norm
-    gauss[_np.isnan(image)] = _np.nan
+    gauss[nans] = _np.nan
     return gauss
 
 
+def _blur_exact(data, blur_radius, tol=None):
+    sigma = (blur_radius, blur_radius) + (0,) * (data.ndim - 2)
+    return _gaussian_filter(data, sigma, mode="constant", cval=0)
+
+
+def _blur_downsample(data, blur_radius, tol=1e-3):
+    # The error of blurring blocks of `f` pixels and interpolating between
+    # them is below 0.07 * (f / blur_radius)**2 times the range of the image
+    f = int(blur_radius * _np.sqrt(tol / 0.1))
+    if f < 2:
+        return _blur_exact(data, blur_radius)
+
+    shape = data.shape[:2]
+    pad = [(0, -n % f) for n in shape] + [(0, 0)] * (data.ndim - 2)
+    blocks = _np.pad(data, pad).reshape(
+        shape[0] // f + bool(pad[0][1]), f, -1, f, *data.shape[2:]
+    )
+    small = blocks.mean((1, 3))
+
+    # Block averaging already blurs by (f**2 - 1) / 12 square pixels. A block
+    # of zeros is added on each side so that the edges are interpolated
+    sigma = _np.sqrt(blur_radius**2 - (f**2 - 1) / 12) / f
+    small = _blur_exact(_np.pad(small, [(1, 1)] * 2 + pad[2:]), sigma)
+
+    # Linear interpolation between block centers
+    for axis, n in enumerate(shape):
+        coords = (_np.arange(n) - (f - 1) / 2) / f + 1
+        i0 = _np.floor(coords).astype(int)
+        w = (coords - i0).reshape((-1,) + (1,) * (data.ndim - axis - 1))
+        small = small.take(i0, axis) * (1 - w) + small.take(i0 + 1, axis) * w
+    return small
+
+
+def _blur_iir(data, blur_radius, tol=None):
+    # Fourth order recursive filter of Deriche (1993), as the sum of a causal
+    # and an anticausal pass over the data, which both start from zeros
+    # outside of the image as the exact filter does
+    num, den = [0], [1]
+    h0 = total = 0
+    for a, b, w, k in [(1.68, 3.735, 0.6318, 1.783), (-0.6803, -0.2598, 1.997, 1.723)]:
+        # Kernel term a cos(w x) + b sin(w x), decaying as exp(-k x)
+        z = _np.exp((-k + 1j * w) / blur_radius)
+        alpha = (a - 1j * b) / 2
+        pair_num = [2 * alpha.real, -2 * (alpha * z.conjugate()).real]
+        pair_den = [1, -2 * z.real, abs(z) ** 2]
+        num = _np.polyadd(_np.polymul(num, pair_den), _np.polymul(pair_num, den))
+        den = _np.polymul(den, pair_den)
+        h0 += 2 * alpha.real
+        total += 2 * (alpha / (1 - z)).real
+    # Normalized to a unit sum, the center tap being shared by both passes
+    norm = 2 * total - h0
+    num = num / norm
+    h0 /= norm
+
+    for axis in (0, 1):
+        causal = _lfilter(num, den, data, axis=axis)
+        anticausal = _np.flip(_lfilter(num, den, _np.flip(data, axis), axis=axis), axis)
+        data = causal + anticausal - h0 * data
+    return data
+
+
+class LinearityCorrector:
+    """Linearity correction with the per band curves computed once.
+
+    If `lut_size` is given, the curves are resampled on a uniform grid of
+    `lut_size` points that is indexed directly instead of searched. Between
+    the grid points the curves are interpolated linearly, so the error is
+    bounded by the curvature of the response over one grid step.
+
+    Frames are processed by blocks of `block` rows into `dtype` arrays. Pass
+    `out=data` to correct a frame of the same dtype in place.
+    """
+
+    def __init__(self, lin_data="linearity.csv", lut_size=None, dtype=_np.float32):
+        if type(lin_data) == str:
+            lin_data = _pd.read_csv(lin_data)
+
+        exposure = lin_data["Exposure"].to_numpy(dtype=float)
+        idx = _np.argmin(_np.abs(exposure - 0.05))
+
+        self.dtype = dtype
+        self.xp = []
+        self.fp = []
+        for band in "RGB":
+            values = lin_data[band].to_numpy(dtype=float)
+            self.xp.append(values[::-1])
+            self.fp.append(values[idx] / exposure[idx] * exposure[::-1])
+
+        self.lut = None
+        if lut_size is not None:
+            self.lut = []
+            for xp, fp in zip(self.xp, self.fp):
+                grid = _np.linspace(xp[0], xp[-1], lut_size)
+                lut = _np.interp(grid, xp, fp).astype(dtype)
+                slope = _np.append(_np.diff(lut), 0).astype(dtype)
+                self.lut.append((xp[0], (lut_size - 1) / (xp[-1] - xp[0]), lut, slope))
+
+    def __call__(self, data, out=None, block=256):
+        if out is None:
+            out = _np.empty(data.shape, dtype=self.dtype)
+        for r in range(0, data.shape[0], block):
+            for b in range(data.shape[-1]):
+                layer = data[r : r + block, ..., b]
+                if self.lut is None:
+                    out[r : r + block, ..., b] = _np.interp(
+                        layer, self.xp[b], self.fp[b]
+                    )
+                else:
+                    out[r : r + block, ..., b] = self._lookup(layer, *self.lut[b])
+        return out
+
+    def _lookup(self, layer, x0, scale, lut, slope):
+        pos = _np.subtract(layer, x0, dtype=self.dtype)
+        pos *= scale
+        nans = _np.isnan(pos)
+        pos[nans] = 0
+        _np.clip(pos, 0, len(lut) - 1, out=pos)
+        idx = pos.astype(_np.intp)
+        pos -= idx
+        pos *= slope[idx]
+        pos += lut[idx]
+        pos[nans] = _np.nan
+        return pos
+
+
 def correct_linearity(data, lin_data="linearity.csv"):
-    if type(lin_data) == str:
-        lin_data = _pd.read_csv(lin_data)
-
-    idx = _np.argmin(_np.abs(lin_data["Exposure"] - 0.05))
-
-    return _np.stack(
-        [
-            _np.interp(layer, lin_data[band][::-1], c)
-            for band, layer, c in zip(
-                "RGB",
-                _np.moveaxis(data, -1, 0),
-                (
-                    lin_data[band][idx]
-                    / lin_data["Exposure"][idx]
-                    * lin_data["Exposure"][::-1]
-                    for band in "RGB"
-                ),
+    if not isinstance(lin_data, LinearityCorrector):
+        lin_data = LinearityCorrector(lin_data, dtype=_np.float64)
+
+    return lin_data(data)
+
+
+def percentile_partition(image, percentile):
+    """Percentiles of each band of `image`, along the rows of the result.
+
+    2D images are a single band. Only the order statistics around the
+    requested ranks are selected, in a single `np.partition` per band.
+    Identical to `np.percentile`, bands containing nans giving nans.
+    """
+    if image.ndim == 2:
+        image = image[..., None]
+    data = _np.moveaxis(image, -1, 0).reshape(image.shape[-1], -1)
+    if _np.shares_memory(data, image):
+        data = data.copy()  # Partitioned in place
+    pos = _np.asarray(percentile, dtype=float) / 100 * (data.shape[1] - 1)
+    lo = _np.floor(pos).astype(int)
+    hi = _np.minimum(lo + 1, data.shape[1] - 1)
+    nans = _np.isnan(data).any(1) if data.dtype.kind == "f" else False
+    data.partition(_np.unique(_np.concatenate([lo, hi])), axis=1)
+    frac = (pos - lo)[:, None]
+    out = (data[:, lo] * (1 - frac.T) + data[:, hi] * frac.T).T
+    out[:, nans] = _np.nan
+    return out
+
+
+def percentile_histogram(image, percentile):
+    """Percentiles of each band of an integer `image`, along the rows.
+
+    2D images are a single band. The order statistics are found from the
+    cumulative histogram of each band, in linear time. Identical to
+    `np.percentile`.
+    """
+    if image.dtype.kind not in "iu":
+        raise ValueError("The histogram method requires integer data")
+    if image.ndim == 2:
+        image = image[..., None]
+
+    data = image.reshape(-1, image.shape[-1])
+    offset = int(data.min()) if image.dtype.kind == "i" else 0
+    counts = [
+        _np.bincount(data[:, b] - offset if offset else data[:, b])
+        for b in range(data.shape[1])
+    ]
+    return _histogram_percentile(counts, percentile, offset)
+
+
+def _histogram_percentile(counts, percentile, offset=0):
+    # Linear interpolation between the order statistics, as `np.percentile`
+    out = _np.empty((len(percentile), len(counts)))
+    for b, count in enumerate(counts):
+        cumul = _np.cumsum(count)
+        pos = _np.asarray(percentile, dtype=float) / 100 * (cumul[-1] - 1)
+        lo = _np.floor(pos).astype(_np.int64)
+        hi = _np.minimum(lo + 1, cumul[-1] - 1)
+        vlo = _np.searchsorted(cumul, lo, side="right") + offset
+        vhi = _np.searchsorted(cumul, hi, side="right") + offset
+        out[:, b] = vlo + (vhi - vlo) * (pos - lo)
+    return out
+
+
+class Histogram:
+    """Streaming histogram of the values of each band of frames.
+
+    Without a `range`, every integer value in `[0, size)` has its own bin and
+    the percentiles of all the frames are exact. With `range=(lo, hi)`, any
+    data is binned in `size` bins spanning it, values outside of it falling in
+    the first or last bin, and the percentiles are given at the bin centers.
+    Histograms of different frame sets can be merged with `+=` and saved to
+    `.npz` files.
+    """
+
+    def __init__(self, bands=3, size=2**16, range=None):
+        self.counts = _np.zeros((bands, size), dtype=_np.int64)
+        self.range = None if range is None else tuple(map(float, range))
+        self.frames = 0
+
+    def _bins(self, band):
+        size = self.counts.shape[1]
+        if self.range is None:
+            if band.dtype.kind not in "iu":
+                raise ValueError("Histograms of non-integer data require a value range")
+            return band.ravel()
+        lo, hi = self.range
+        band = _np.asarray(band, dtype=_np.float64).ravel()
+        band = band[~_np.isnan(band)]
+        bins = _np.floor((band - lo) * (size / (hi - lo)))
+        return _np.clip(bins, 0, size - 1).astype(_np.int64)
+
+    def update(self, image):
+        if image.ndim == 2:
+            image = image[..., None]
+        if image.shape[-1] != len(self.counts):
+            raise ValueError(
+                f"Expected {len(self.counts)} bands, got {image.shape[-1]}"
             )
-        ],
-        axis=2,
-    )
+        size = self.counts.shape[1]
+        for b, band in enumerate(_np.moveaxis(image, -1, 0)):
+            count = _np.bincount(self._bins(band), minlength=size)
+            if len(count) > size:
+                raise ValueError(f"Values exceed the histogram size of {size}")
+            self.counts[b] += count
+        self.frames += 1
+        return self
+
+    def __iadd__(self, other):
+        if other.counts.shape != self.counts.shape or other.range != self.range:
+            raise ValueError("Histograms with different bins can't be merged")
+        self.counts += other.counts
+        self.frames += other.frames
+        return self
+
+    def percentile(self, percentile):
+        """Percentiles of each band, along the rows of the result."""
+        p = _histogram_percentile(self.counts, percentile)
+        if self.range is None:
+            return p
+        lo, hi = self.range
+        return lo + (p + 0.5) * ((hi - lo) / self.counts.shape[1])
+
+    def save(self, fname):
+        _np.savez_compressed(
+            fname,
+            counts=self.counts,
+            frames=self.frames,
+            range=_np.array(self.range or (_np.nan, _np.nan)),
+        )
+
+    @classmethod
+    def load(cls, fname):
+        with _np.load(fname) as f:
+            range = f["range"] if "range" in f else [_np.nan]
+            hist = cls(*f["counts"].shape, None if _np.isnan(range[0]) else range)
+            hist.counts[...] = f["counts"]
+            hist.frames = int(f["frames"])
+        return hist
+
+
+def load_data(fname):
+    """Open a calibration data product as a read-only memory map.
+
+    Processes opening the same file share a single physical copy of it.
+    """
+    return _np.load(fname, mmap_mode="r")
+
+
+def save_data(fname, data):
+    """Save a calibration data product as a contiguous float32 array."""
+    _np.save(fname, _np.ascontiguousarray(data, dtype=_np.float32))
 
 
 def correct_flat(data, flat_data="flatfield.npy"):
     if type(flat_data) == str:
-        flat_data = _np.load(flat_data)
+        flat_data = load_data(flat_data)
 
     return data / (flat_data / flat_data.max((0, 1)))